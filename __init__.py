@@ -1,16 +1,49 @@
 """Modbus Charger integration."""
+import asyncio
 import logging
 
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
 from homeassistant.exceptions import ConfigEntryNotReady
 
-from .const import DOMAIN, CONF_HOST, CONF_PORT, CONF_SLAVE_ID
-from .read_device_info import identify_subdevices
+from .const import (
+    DOMAIN,
+    CONF_HOST,
+    CONF_PORT,
+    CONF_SLAVE_ID,
+    CONF_FRAME_DELAY,
+    CONF_MAX_IN_FLIGHT,
+    DEFAULT_FRAME_DELAY,
+    DEFAULT_MAX_IN_FLIGHT,
+)
+from .client import async_acquire_client, async_release_client
+from .read_device_info import async_identify_subdevices
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def _connection_params(entry: ConfigEntry) -> tuple[str, int, int]:
+    """Return (host, port, slave) of a config entry."""
+    return (
+        entry.data[CONF_HOST],
+        entry.data.get(CONF_PORT, 502),
+        entry.data.get(CONF_SLAVE_ID, 82),
+    )
+
+
+async def _async_identify_subdevices(
+    hass: HomeAssistant, host: str, port: int, slave: int, frame_delay: float = 0.0, max_in_flight: int = 1
+) -> list[dict]:
+    """Identify the CHARGER sub-devices over the gateway's shared connection."""
+    # Bounded so a hung device can't stall startup
+    shared = async_acquire_client(hass, host, port, frame_delay, max_in_flight)
+    try:
+        chargers = await asyncio.wait_for(async_identify_subdevices(shared, slave), timeout=5)
+    finally:
+        async_release_client(hass, shared)
+    return chargers
+
+
 async def async_setup(hass: HomeAssistant, config: dict):
     """Set up the integration (only called for YAML mode)."""
     # We handle everything via config entries
@@ -19,19 +52,17 @@ async def async_setup(hass: HomeAssistant, config: dict):
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Set up a config entry (called by the UI)."""
-    host = entry.data[CONF_HOST]
-    port = entry.data.get(CONF_PORT, 502)
-    slave = entry.data.get(CONF_SLAVE_ID, 82)
+    host, port, slave = _connection_params(entry)
 
     # Quick connectivity check: try to identify subdevices once
     try:
-        # Run in executor to avoid blocking
-        chargers = await hass.async_add_executor_job(
-            identify_subdevices,
+        chargers = await _async_identify_subdevices(
+            hass,
             host,
             port,
             slave,
-            3  # small timeout for quick check
+            entry.data.get(CONF_FRAME_DELAY, DEFAULT_FRAME_DELAY) / 1000,
+            entry.data.get(CONF_MAX_IN_FLIGHT, DEFAULT_MAX_IN_FLIGHT),
         )
         if not chargers:
             _LOGGER.warning("No EMMA CHARGER sub-devices found at %s:%s", host, port)
@@ -40,9 +71,11 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
         # Inform HA to retry later
         raise ConfigEntryNotReady from e
 
-    # Store config & forward to sensor platform
-    hass.data.setdefault(DOMAIN, {})[entry.entry_id] = entry.data
+    # Store the discovered chargers & forward to sensor platform
+    hass.data.setdefault(DOMAIN, {})[entry.entry_id] = chargers
     await hass.config_entries.async_forward_entry_setups(entry, ["sensor"])
+    # Reload, and so rediscover, when the entry's settings change
+    entry.async_on_unload(entry.add_update_listener(async_reload_entry))
     _LOGGER.debug("Huawei Emma Charger config entry set up: %s", entry.entry_id)
     return True
 
@@ -64,5 +97,4 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
 
 async def async_reload_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Reload a config entry."""
-    await async_unload_entry(hass, entry)
-    return await async_setup_entry(hass, entry)
+    await hass.config_entries.async_reload(entry.entry_id)
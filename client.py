@@ -0,0 +1,273 @@
+"""Shared Modbus TCP connection for the Huawei Emma Charger integration."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import socket
+import struct
+from typing import TYPE_CHECKING
+
+from .const import DOMAIN
+
+if TYPE_CHECKING:
+    from homeassistant.core import HomeAssistant
+
+_LOGGER = logging.getLogger(__name__)
+
+# Timeout in seconds for connecting and for each Modbus request
+REQUEST_TIMEOUT = 1.5
+
+CLIENTS = "_clients"
+
+# Detect a dead gateway after ~60s of silence instead of on the next read
+_KEEPALIVE_IDLE = 30
+_KEEPALIVE_INTERVAL = 10
+_KEEPALIVE_COUNT = 3
+
+# Consecutive timeouts with no frame received in between after which the
+# connection counts as stalled; a single silent slave never gets there as
+# long as any other slave answers
+_STALL_TIMEOUTS = 3
+
+# MBAP header: transaction id, protocol id (0), length, unit id
+_MBAP = struct.Struct(">HHHB")
+# Longest valid MBAP length field: unit id plus a 253 byte PDU
+_MAX_MBAP_LENGTH = 254
+# Read holding registers request: MBAP, function 0x03, address, count
+_READ_HOLDING = struct.Struct(">HHHBBHH")
+# Read device identification request: MBAP, function 0x2B, MEI 0x0E, read code, object id
+_READ_DEVICE_ID = struct.Struct(">HHHBBBBB")
+
+_FC_READ_HOLDING = 0x03
+_FC_READ_DEVICE_ID = 0x2B
+
+# Exception codes hinting that a slave is gone or is a different device now
+ILLEGAL_DATA_ADDRESS = 0x02
+GATEWAY_TARGET_FAILED = 0x0B
+
+
+class ModbusError(Exception):
+    """Error response of a slave to a Modbus request."""
+
+    def __init__(self, function: int, code: int):
+        super().__init__(f"Modbus exception {code} for function 0x{function:02X}")
+        self.function = function
+        self.code = code
+
+
+def _tune_socket(writer: asyncio.StreamWriter) -> None:
+    """Disable Nagle and enable TCP keepalive on the connection's socket."""
+    sock = writer.get_extra_info("socket")
+    if sock is None:
+        _LOGGER.debug("No socket to tune on Modbus connection")
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, _KEEPALIVE_IDLE)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, _KEEPALIVE_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, _KEEPALIVE_COUNT)
+    except OSError as err:
+        _LOGGER.debug("Could not set socket options on Modbus connection: %s", err)
+
+
+class SharedModbusClient:
+    """Modbus TCP connection shared by all coordinators talking to one gateway.
+
+    Many gateways accept a single TCP client only, so requests for every
+    slave behind (host, port) go through one socket, one at a time by
+    default. Gateways known to cope can get up to max_in_flight requests
+    pipelined; responses are matched to their request by the MBAP
+    transaction id, so the round trips overlap. With a frame delay, for
+    gateways bridging to an RTU bus, requests are always sent one at a time
+    with that pause in between.
+    """
+
+    def __init__(self, host: str, port: int, frame_delay: float = 0.0, max_in_flight: int = 1):
+        self.host = host
+        self.port = port
+        # Seconds to wait after each response before the next request
+        self.frame_delay = frame_delay
+        self.max_in_flight = max_in_flight
+        # Serializes (re)connecting
+        self.lock = asyncio.Lock()
+        self.refcount = 0
+        # (start, count) of reads spanning unmapped registers the gateway rejected
+        self.rejected_reads: set[tuple[int, int]] = set()
+        self._slots = asyncio.Semaphore(max_in_flight)
+        # Held for a whole request while a frame delay is set
+        self._turn = asyncio.Lock()
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._receiver: asyncio.Task | None = None
+        # transaction id -> future resolved with (function, payload) of the response
+        self._pending: dict[int, asyncio.Future] = {}
+        self._tid = 0
+        # Timeouts since the last frame received, tells a stalled socket from a slow slave
+        self._silent_timeouts = 0
+
+    def set_max_in_flight(self, max_in_flight: int) -> None:
+        """Change how many requests may be outstanding at once."""
+        if max_in_flight != self.max_in_flight:
+            # Requests holding a slot of the old semaphore simply release it
+            self.max_in_flight = max_in_flight
+            self._slots = asyncio.Semaphore(max_in_flight)
+
+    async def _async_connect(self) -> asyncio.StreamWriter:
+        """Return the open connection, (re)connecting it if needed."""
+        async with self.lock:
+            if self._writer is None or self._writer.is_closing():
+                self.close()
+                try:
+                    async with asyncio.timeout(REQUEST_TIMEOUT):
+                        reader, writer = await asyncio.open_connection(self.host, self.port)
+                except OSError as err:
+                    raise ConnectionError(f"Modbus connect failed to {self.host}:{self.port}: {err}") from err
+                _tune_socket(writer)
+                self._reader, self._writer = reader, writer
+                self._silent_timeouts = 0
+                self._receiver = asyncio.get_running_loop().create_task(self._async_receive(reader))
+            return self._writer
+
+    async def _async_receive(self, reader: asyncio.StreamReader) -> None:
+        """Hand each response on the connection to the request waiting for it."""
+        try:
+            while True:
+                tid, protocol, length, _unit = _MBAP.unpack(await reader.readexactly(_MBAP.size))
+                if protocol != 0 or not 2 <= length <= _MAX_MBAP_LENGTH:
+                    # The stream can't be resynchronized after a bad header
+                    _LOGGER.warning("Invalid Modbus frame from %s:%s (protocol %s, length %s), reconnecting",
+                                    self.host, self.port, protocol, length)
+                    break
+                pdu = await reader.readexactly(length - 1)
+                self._silent_timeouts = 0
+                future = self._pending.pop(tid, None)
+                if future is None or future.done():
+                    # Answer to a request that already timed out
+                    continue
+                future.set_result((pdu[0], pdu[1:]))
+        except (asyncio.IncompleteReadError, OSError) as err:
+            _LOGGER.debug("Modbus connection to %s:%s lost: %s", self.host, self.port, err)
+        finally:
+            if self._reader is reader:
+                # Drop the dead connection, the next request reconnects
+                self._receiver = None
+                self.close()
+
+    def _fail_pending(self, err: Exception) -> None:
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(err)
+
+    def close(self) -> None:
+        """Close the connection so the next request reconnects."""
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+        self._fail_pending(ConnectionError(f"Connection to {self.host}:{self.port} closed"))
+
+    async def _async_request(self, request: struct.Struct, function: int, slave: int, *fields: int) -> bytes:
+        """Send one request over the shared connection and return the response payload.
+
+        Raises ConnectionError or TimeoutError when the gateway is unreachable
+        and ModbusError when the slave answers with an error.
+        """
+        if not self.frame_delay:
+            return await self._async_send(request, function, slave, *fields)
+        async with self._turn:
+            try:
+                return await self._async_send(request, function, slave, *fields)
+            finally:
+                # Leave the RTU bus idle before the next frame
+                await asyncio.sleep(self.frame_delay)
+
+    async def _async_send(self, request: struct.Struct, function: int, slave: int, *fields: int) -> bytes:
+        async with self._slots:
+            writer = await self._async_connect()
+            self._tid = tid = (self._tid + 1) & 0xFFFF
+            future = self._pending[tid] = asyncio.get_running_loop().create_future()
+            writer.write(request.pack(tid, 0, request.size - 6, slave, function, *fields))
+            try:
+                async with asyncio.timeout(REQUEST_TIMEOUT):
+                    response_function, payload = await future
+            except TimeoutError:
+                self._pending.pop(tid, None)
+                if self._writer is writer:
+                    self._silent_timeouts += 1
+                    if self._silent_timeouts >= _STALL_TIMEOUTS:
+                        # Nothing came back for a while, drop the stalled socket;
+                        # keepalive catches a dead peer, this a hung gateway
+                        _LOGGER.debug("No response from %s:%s to %s requests, reconnecting",
+                                      self.host, self.port, self._silent_timeouts)
+                        self.close()
+                raise
+            except ConnectionError:
+                self.close()
+                raise
+        if response_function & 0x80:
+            raise ModbusError(function, payload[0] if payload else 0)
+        return payload
+
+    async def async_read_holding_registers(self, slave: int, address: int, count: int) -> bytes:
+        """Read holding registers of a slave behind the gateway as raw big-endian bytes."""
+        payload = await self._async_request(_READ_HOLDING, _FC_READ_HOLDING, slave, address, count)
+        data = payload[1:1 + payload[0]]
+        if len(data) != count * 2:
+            raise ValueError(f"Expected {count} registers from slave {slave}, got {len(data)} bytes")
+        return data
+
+    async def async_read_device_information(self, slave: int, object_id: int) -> tuple[dict[int, bytes], int | None]:
+        """Read extended device identification objects (0x2B/0x0E) from object_id on.
+
+        Returns the objects and the next object id to page from, or None
+        when no more objects follow. Raises ValueError on a truncated response.
+        """
+        payload = await self._async_request(_READ_DEVICE_ID, _FC_READ_DEVICE_ID, slave, 0x0E, 3, object_id)
+        if len(payload) < 6:
+            raise ValueError(f"Short device identification response from slave {slave}: {len(payload)} bytes")
+        # MEI type, read code, conformity, more follows, next object id, number of objects
+        more_follows, next_object_id, num_objects = payload[3], payload[4], payload[5]
+        information = {}
+        pos = 6
+        for _ in range(num_objects):
+            if pos + 2 > len(payload) or pos + 2 + payload[pos + 1] > len(payload):
+                raise ValueError(f"Truncated device identification object from slave {slave} at byte {pos}")
+            oid, length = payload[pos], payload[pos + 1]
+            information[oid] = payload[pos + 2:pos + 2 + length]
+            pos += 2 + length
+        return information, next_object_id if more_follows else None
+
+
+def async_acquire_client(
+    hass: HomeAssistant, host: str, port: int, frame_delay: float = 0.0, max_in_flight: int = 1
+) -> SharedModbusClient:
+    """Return the shared client for (host, port), creating it on first use.
+
+    Entries sharing a gateway may ask for different settings, the most
+    cautious ones win: the longest frame delay and the fewest requests
+    in flight.
+    """
+    clients = hass.data.setdefault(DOMAIN, {}).setdefault(CLIENTS, {})
+    shared = clients.get((host, port))
+    if shared is None:
+        shared = clients[(host, port)] = SharedModbusClient(host, port, frame_delay, max_in_flight)
+    shared.frame_delay = max(shared.frame_delay, frame_delay)
+    shared.set_max_in_flight(min(shared.max_in_flight, max_in_flight))
+    shared.refcount += 1
+    return shared
+
+
+def async_release_client(hass: HomeAssistant, shared: SharedModbusClient) -> None:
+    """Release a shared client, closing it when the last user is gone."""
+    shared.refcount -= 1
+    if shared.refcount > 0:
+        return
+    shared.close()
+    hass.data.get(DOMAIN, {}).get(CLIENTS, {}).pop((shared.host, shared.port), None)
+    _LOGGER.debug("Closed Modbus connection to %s:%s", shared.host, shared.port)
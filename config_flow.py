@@ -1,6 +1,5 @@
 '''Config flow for Modbus Charger integration.'''
 import voluptuous as vol
-from pymodbus.client import ModbusTcpClient
 import asyncio
 from homeassistant import config_entries, exceptions
 
@@ -10,9 +9,13 @@ from .const import (
     CONF_PORT,
     CONF_SLAVE_ID,
     CONF_SCAN_INTERVAL,
+    CONF_FRAME_DELAY,
+    CONF_MAX_IN_FLIGHT,
     DEFAULT_PORT,
     DEFAULT_SLAVE_ID,
     DEFAULT_SCAN_INTERVAL,
+    DEFAULT_FRAME_DELAY,
+    DEFAULT_MAX_IN_FLIGHT,
 )
 
 # Schema for user input in the config flow
@@ -21,6 +24,8 @@ DATA_SCHEMA = vol.Schema({
     vol.Optional(CONF_PORT, default=DEFAULT_PORT): int,
     vol.Optional(CONF_SLAVE_ID, default=DEFAULT_SLAVE_ID): int,
     vol.Optional(CONF_SCAN_INTERVAL, default=DEFAULT_SCAN_INTERVAL): int,
+    vol.Optional(CONF_FRAME_DELAY, default=DEFAULT_FRAME_DELAY): vol.All(int, vol.Range(min=0)),
+    vol.Optional(CONF_MAX_IN_FLIGHT, default=DEFAULT_MAX_IN_FLIGHT): vol.All(int, vol.Range(min=1, max=16)),
 })
 
 class ModbusChargerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
@@ -52,21 +57,19 @@ class ModbusChargerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         )
 
     async def _test_connection(self, data):
-        '''Attempt to connect to the Modbus charger using pymodbus.'''
+        '''Attempt to open a Modbus TCP connection to the charger.'''
         host = data[CONF_HOST]
         port = data.get(CONF_PORT, DEFAULT_PORT)
         timeout = 3.0
 
-        def try_connect():
-            client = ModbusTcpClient(host, port=port, timeout=timeout)
-            connected = client.connect()
-            client.close()
-            if not connected:
-                raise CannotConnect
-            return True
-
-        # Run blocking IO in executor
-        return await self.hass.async_add_executor_job(try_connect)
+        try:
+            async with asyncio.timeout(timeout):
+                _reader, writer = await asyncio.open_connection(host, port)
+        except (OSError, TimeoutError) as err:
+            raise CannotConnect from err
+        writer.close()
+        await writer.wait_closed()
+        return True
 
 class CannotConnect(exceptions.HomeAssistantError):
     '''Error to indicate we cannot connect to the charger.'''
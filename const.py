@@ -1,27 +1,41 @@
 """Constants for the Huawei Emma Charger integration."""
+from collections import namedtuple
 
 DOMAIN = "huawei_emma_charger"
 CONF_HOST = "host"
 CONF_PORT = "port"
 CONF_SLAVE_ID = "slave_id"
 CONF_SCAN_INTERVAL = "scan_interval"
+CONF_FRAME_DELAY = "frame_delay"
+CONF_MAX_IN_FLIGHT = "max_in_flight"
 
 DEFAULT_PORT = 502
 DEFAULT_SLAVE_ID = 0
 DEFAULT_SCAN_INTERVAL = 30  # seconds
+# Pause between requests for gateways bridging to Modbus RTU, 0 for none
+DEFAULT_FRAME_DELAY = 0  # milliseconds
+# Requests pipelined on the gateway connection; 1 waits for each response
+DEFAULT_MAX_IN_FLIGHT = 1
 
-# Register definitions: (key, name, address, quantity, type, gain, unit)
-SENSOR_TYPES = [
-    ("offering_name",    "Offering name",    30000, 15, "STR",   1,    ""),
-    ("esn",              "ESN",              30015, 16, "STR",   1,    ""),
-    ("software_version", "Software version", 30031, 16, "STR",   1,    ""),
-    ("rated_power",      "Rated power",      30076, 2,  "U32",  10,   "kW"),
-    ("charger_model",    "Charger model",    30078, 14, "STR",   1,    ""),
-    ("bluetooth_name",   "Bluetooth name",   30094, 16, "STR",   1,    ""),
-    ("phase_a_voltage",  "Phase A voltage",  30500, 2,  "U32",  10,   "V"),
-    ("phase_b_voltage",  "Phase B voltage",  30502, 2,  "U32",  10,   "V"),
-    ("phase_c_voltage",  "Phase C voltage",  30504, 2,  "U32",  10,   "V"),
-    ("total_energy",     "Total energy",     30506, 2,  "U32", 1000,  "kWh"),
-    ("charger_temp",     "Charger temp.",    30508, 2,  "I32",  10,   "°C"),
-    ("device_name",      "Device Name",      65524,10,  "STR",   1,     ""),
-]
+# How long a coordinator polls the same chargers before rediscovering them
+CHARGERS_CACHE_TTL = 600  # seconds
+
+Sensor = namedtuple("Sensor", "key name address quantity rtype gain unit ttl")
+
+# Register definitions; rtype is one of U16, I16, U32, I32, FLOAT or STR
+# ttl: seconds a read value is reused before the register is polled again,
+# 0 polls it every scan. Nameplate and identity data rarely changes.
+SENSOR_TYPES = (
+    Sensor("offering_name",    "Offering name",    30000, 15, "STR",   1,    "",    3600),
+    Sensor("esn",              "ESN",              30015, 16, "STR",   1,    "",    3600),
+    Sensor("software_version", "Software version", 30031, 16, "STR",   1,    "",    3600),
+    Sensor("rated_power",      "Rated power",      30076, 2,  "U32",  10,   "kW",  3600),
+    Sensor("charger_model",    "Charger model",    30078, 14, "STR",   1,    "",    3600),
+    Sensor("bluetooth_name",   "Bluetooth name",   30094, 16, "STR",   1,    "",    3600),
+    Sensor("phase_a_voltage",  "Phase A voltage",  30500, 2,  "U32",  10,   "V",   0),
+    Sensor("phase_b_voltage",  "Phase B voltage",  30502, 2,  "U32",  10,   "V",   0),
+    Sensor("phase_c_voltage",  "Phase C voltage",  30504, 2,  "U32",  10,   "V",   0),
+    Sensor("total_energy",     "Total energy",     30506, 2,  "U32", 1000,  "kWh", 0),
+    Sensor("charger_temp",     "Charger temp.",    30508, 2,  "I32",  10,   "°C",  0),
+    Sensor("device_name",      "Device Name",      65524,10,  "STR",   1,     "",   3600),
+)
@@ -1,70 +1,59 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from __future__ import annotations
+
 import logging
-from pymodbus.client import ModbusTcpClient
-from pymodbus.exceptions import ModbusIOException, ModbusException
-from pymodbus.pdu import ExceptionResponse
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .client import SharedModbusClient
 
 _LOGGER = logging.getLogger(__name__)
 
+# Ein Paar 'ID=Wert' innerhalb von '1=EMMA-A02;2=V100R024;...'; die ID wird
+# wie von int() akzeptiert (Leerraum, Vorzeichen, Unterstriche)
+_PAIR_RE = re.compile(r'(?:^|;)[ \t\n\v\f\r]*([+-]?\d+(?:_\d+)*)[ \t\n\v\f\r]*=([^;]*)')
 
-def read_device_list(host: str, port: int = 502, slave: int = 1, timeout: float = 3.0):
+
+async def async_read_device_list(client: SharedModbusClient, slave: int = 1) -> tuple[int, dict[int, bytes]]:
     """
-    Liest per ReadDevId=3 (Function 0x2B), ObjectID=0x87 alle Subgeräte-Infos.
+    Liest per ReadDevId=3 (Function 0x2B), ObjectID=0x87 alle Subgeräte-Infos
+    über die gemeinsame Verbindung des Gateways.
     Führt Paging durch, bis keine weiteren Pakete folgen.
 
     Args:
-      host: IP oder Hostname des Modbus-TCP-Geräts
-      port: TCP-Port (Standard 502)
+      client: Gemeinsamer Modbus-Client des Gateways
       slave: Master-Slave-ID für ReadDevId
-      timeout: Timeout in Sekunden
 
     Returns:
       Tuple[num_devices (int), info_dict (dict[int, bytes])] - Anzahl Geräte und rohes Bytes pro ObjectID
     """
-    client = ModbusTcpClient(host, port=port, timeout=timeout)
-    if not client.connect():
-        raise ConnectionError(f"Verbindung zu {host}:{port} fehlgeschlagen")
-    try:
-        _LOGGER.debug("Lese Device List (OID=0x87)…")
-        all_info = {}
-        object_id = 0x87
-
-        while True:
-            try:
-                resp = client.read_device_information(
-                    read_code=3,
-                    object_id=object_id,
-                    slave=slave
-                )
-            except ModbusIOException as e:
-                raise ConnectionError(f"Keine Antwort für OID=0x{object_id:02X}: {e}")
-
-            if isinstance(resp, ExceptionResponse) or resp.isError():
-                raise ModbusException(f"Modbus-Error bei OID=0x{object_id:02X}: {resp}")
-
-            all_info.update(resp.information)
-
-            if getattr(resp, "more_follows", False):
-                object_id = resp.next_object_id
-                _LOGGER.debug(f"Paging: weitere Daten ab OID=0x{object_id:02X}")
-                continue
-            break
+    _LOGGER.debug("Lese Device List (OID=0x87)…")
+    all_info = {}
+    object_id = 0x87
+
+    while object_id is not None:
+        information, object_id = await client.async_read_device_information(slave, object_id)
+        for oid, value in information.items():
+            all_info[oid] = value
+        if object_id is not None:
+            _LOGGER.debug("Paging: weitere Daten ab OID=0x%02X", object_id)
 
-        raw_count = all_info.get(0x87)
-        if raw_count is None:
-            raise ValueError("Antwort enthält keine Objekt-ID 0x87")
-        num_devices = int.from_bytes(raw_count, byteorder='big')
-        return num_devices, all_info
-    finally:
-        client.close()
+    raw_count = all_info.get(0x87)
+    if raw_count is None:
+        raise ValueError("Antwort enthält keine Objekt-ID 0x87")
+    # Die Anzahl ist üblicherweise ein einzelnes Byte
+    num_devices = raw_count[0] if len(raw_count) == 1 else int.from_bytes(raw_count, byteorder='big')
+    return num_devices, all_info
 
 
 def parse_device_description(desc_bytes: bytes) -> dict[int, str]:
     """
     Wandelt ein Byte-Paket in einen ASCII-String um und parsed
-    '1=EMMA-A02;2=V100R024;...' in ein Dict {attr_id: value}.
+    '1=EMMA-A02;2=V100R024;...' per Regex in ein Dict {attr_id: value}.
+    Paare ohne numerischen Schlüssel werden übersprungen.
 
     Args:
       desc_bytes: Rohbytes der Beschreibung
@@ -73,19 +62,10 @@ def parse_device_description(desc_bytes: bytes) -> dict[int, str]:
       Dict[int, str]: Attribut-IDs als Keys, Werte als Strings
     """
     desc_str = desc_bytes.decode('ascii', errors='ignore').rstrip('\x00')
-    attrs = {}
-    for pair in desc_str.split(';'):
-        if '=' not in pair:
-            continue
-        k, v = pair.split('=', 1)
-        try:
-            attrs[int(k)] = v
-        except ValueError:
-            _LOGGER.debug(f"Unbekannter Schlüssel {k} in Beschreibung: {v}")
-    return attrs
+    return {int(k): v for k, v in _PAIR_RE.findall(desc_str)}
 
 
-def identify_subdevices(host: str, port: int = 502, master_slave: int = 1, timeout: float = 3.0) -> list[dict]:
+async def async_identify_subdevices(client: SharedModbusClient, master_slave: int = 1) -> list[dict]:
     """
     Identifiziert alle Sub-Devices vom Typ 'CHARGER' und liefert eine Liste von Dicts.
 
@@ -94,8 +74,8 @@ def identify_subdevices(host: str, port: int = 502, master_slave: int = 1, timeo
       attrs (dict[int, str])
       slave_id (int)
     """
-    count, info = read_device_list(host, port, master_slave, timeout)
-    _LOGGER.info(f"Gefundene Geräte insgesamt: {count}")
+    count, info = await async_read_device_list(client, master_slave)
+    _LOGGER.info("Gefundene Geräte insgesamt: %s", count)
     chargers = []
 
     for oid, raw in info.items():
@@ -107,10 +87,10 @@ def identify_subdevices(host: str, port: int = 502, master_slave: int = 1, timeo
             try:
                 sid = int(sid_val)
             except (TypeError, ValueError):
-                _LOGGER.warning(f"Ungültige Slave-ID in OID=0x{oid:02X}: {sid_val}")
+                _LOGGER.warning("Ungültige Slave-ID in OID=0x%02X: %s", oid, sid_val)
                 continue
             chargers.append({"obj_id": oid, "attrs": attrs, "slave_id": sid})
-            _LOGGER.info(f"Charger gefunden: OID=0x{oid:02X}, Slave ID={sid}")
+            _LOGGER.info("Charger gefunden: OID=0x%02X, Slave ID=%s", oid, sid)
 
     if not chargers:
         _LOGGER.warning("Kein CHARGER-Sub-Device gefunden.")
@@ -0,0 +1,141 @@
+"""Register read plan for the Huawei Emma Charger integration."""
+import logging
+import struct
+
+from .const import SENSOR_TYPES
+
+_LOGGER = logging.getLogger(__name__)
+
+# Maximum number of registers in a single read request (Modbus spec)
+MAX_READ_REGISTERS = 125
+
+# Gaps of up to this many unused registers are read rather than split
+GAP_TOLERANCE = 8
+
+# How a member's unpacked value becomes its final value
+_KIND_NUM = "num"  # scaled by gain
+_KIND_STR = "str"  # ASCII text, trailing NULs stripped
+_KIND_UNKNOWN = "unknown"  # unsupported type, always None
+
+# rtype -> (struct code, kind)
+_TYPES = {
+    "U16": ("H", _KIND_NUM),
+    "I16": ("h", _KIND_NUM),
+    "U32": ("I", _KIND_NUM),
+    "I32": ("i", _KIND_NUM),
+    "FLOAT": ("f", _KIND_NUM),
+    "STR": ("s", _KIND_STR),
+}
+
+
+def _compile_decoder(start: int, layout: struct.Struct, members: tuple[tuple, ...]):
+    """Generate a function decoding a block's bytes into its member values.
+
+    The unpacking, string decoding and scaling of all members is emitted as
+    straight-line code, so the poll loop needs no per-member dispatch.
+    """
+    names = [f"v{i}" for i in range(len(members))]
+    exprs = []
+    for name, (_key, _name, kind, gain, *_rest) in zip(names, members):
+        if kind == _KIND_NUM:
+            exprs.append(f"{name} / {gain!r}")
+        elif kind == _KIND_STR:
+            exprs.append(f'{name}.decode("ascii", "ignore").rstrip("\\x00")')
+        else:
+            exprs.append("None")
+    source = (
+        "def decode(buf):\n"
+        f"    {', '.join(names)}, = unpack_from(buf)\n"
+        f"    return ({', '.join(exprs)},)\n"
+    )
+    namespace = {"unpack_from": layout.unpack_from}
+    exec(compile(source, f"<decoder {start}>", "exec"), namespace)
+    return namespace["decode"]
+
+
+def _coalesce(entries, max_gap: int) -> list[tuple[int, int, list[tuple]]]:
+    """Greedily merge address-sorted entries into (start, count, entries) groups.
+
+    An entry joins the previous group if it starts at most max_gap registers
+    after the group's end and the group stays within MAX_READ_REGISTERS.
+    """
+    groups: list[tuple[int, int, list[tuple]]] = []
+    for entry in entries:
+        address, quantity = entry[2], entry[3]
+        if groups:
+            start, count, items = groups[-1]
+            end = start + count
+            if end <= address <= end + max_gap and address + quantity - start <= MAX_READ_REGISTERS:
+                items.append(entry)
+                groups[-1] = (start, address + quantity - start, items)
+                continue
+        groups.append((address, quantity, [entry]))
+    return groups
+
+
+def build_plan(sensor_types, max_gap: int = 0) -> tuple[tuple, ...]:
+    """Group Sensor register definitions into read blocks.
+
+    Returns a tuple of (start, count, ttl, members, decode) blocks. decode
+    takes the block's raw bytes and returns the final values of all members,
+    in order. Each member is (key, name, kind, gain, unit, rtype, ttl).
+    The block ttl is the shortest member ttl, 0 if any member is polled
+    every scan.
+    """
+    entries = []
+    for s in sorted(sensor_types, key=lambda s: s.address):
+        code, kind = _TYPES.get(s.rtype, (None, None))
+        if code is None:
+            _LOGGER.warning("Unknown type %s for %s", s.rtype, s.key)
+            code, kind = "s", _KIND_UNKNOWN
+        if code == "s":
+            code = f"{s.quantity * 2}s"
+        elif struct.calcsize(f">{code}") != s.quantity * 2:
+            # Would shift every later member of the block, leave the sensor out
+            _LOGGER.error("Type %s of %s does not fit %s registers, skipping it", s.rtype, s.key, s.quantity)
+            continue
+        entries.append((s.key, s.name, s.address, s.quantity, code, kind, s.gain, s.unit, s.rtype, s.ttl))
+
+    plan = []
+    for start, count, items in _coalesce(entries, max_gap):
+        fmt = ">"
+        end = start
+        for _key, _name, address, quantity, code, *_rest in items:
+            if address > end:
+                fmt += f"{(address - end) * 2}x"
+            fmt += code
+            end = address + quantity
+        members = tuple(
+            (key, name, kind, gain if kind == _KIND_NUM else None, unit, rtype, ttl)
+            for key, name, _address, _quantity, _code, kind, gain, unit, rtype, ttl in items
+        )
+        decode = _compile_decoder(start, struct.Struct(fmt), members)
+        plan.append((start, count, min(m[6] for m in members), members, decode))
+    return tuple(plan)
+
+
+def _splits(coarse: tuple[tuple, ...], fine: tuple[tuple, ...]) -> dict[tuple[int, int], tuple[tuple, ...]]:
+    """Map each coarse block covering several fine blocks to those blocks."""
+    splits = {}
+    for start, count, *_rest in coarse:
+        parts = tuple(block for block in fine if start <= block[0] < start + count)
+        if len(parts) > 1:
+            splits[(start, count)] = parts
+    return splits
+
+
+# Strictly contiguous registers, the last resort when a gateway rejects gaps
+_CONTIGUOUS_PLAN = build_plan(SENSOR_TYPES)
+
+# Blocks bridging small gaps, reading a few unused registers saves a request
+PLAN = build_plan(SENSOR_TYPES, max_gap=GAP_TOLERANCE)
+
+# Nearby blocks fetched together, skipping over unmapped registers
+WIDE_PLAN = build_plan(SENSOR_TYPES, max_gap=MAX_READ_REGISTERS)
+
+# (start, count) of a block spanning unmapped registers -> the finer blocks
+# to read instead when a gateway rejects it: WIDE_PLAN -> PLAN -> contiguous
+SPLITS = {
+    **_splits(WIDE_PLAN, PLAN),
+    **_splits(PLAN, _CONTIGUOUS_PLAN),
+}
@@ -1,13 +1,14 @@
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from pymodbus.client import ModbusTcpClient
-from pymodbus.exceptions import ModbusException
-from pymodbus.pdu import ExceptionResponse
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any, Final
 
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
-from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, CoordinatorEntity
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, CoordinatorEntity, UpdateFailed
 from homeassistant.components.sensor import SensorEntity, SensorDeviceClass
 from homeassistant.helpers.entity import DeviceInfo
 
@@ -17,12 +18,26 @@ from .const import (
     CONF_PORT,
     CONF_SLAVE_ID,
     CONF_SCAN_INTERVAL,
+    CONF_FRAME_DELAY,
+    CONF_MAX_IN_FLIGHT,
     DEFAULT_PORT,
     DEFAULT_SLAVE_ID,
     DEFAULT_SCAN_INTERVAL,
+    DEFAULT_FRAME_DELAY,
+    DEFAULT_MAX_IN_FLIGHT,
+    CHARGERS_CACHE_TTL,
     SENSOR_TYPES,
 )
-from .read_device_info import identify_subdevices
+from .client import (
+    GATEWAY_TARGET_FAILED,
+    ILLEGAL_DATA_ADDRESS,
+    ModbusError,
+    SharedModbusClient,
+    async_acquire_client,
+    async_release_client,
+)
+from .read_device_info import async_identify_subdevices
+from .registers import SPLITS, WIDE_PLAN
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -30,6 +45,37 @@ _LOGGER = logging.getLogger(__name__)
 STATE_CLASS_MEASUREMENT = "measurement"
 STATE_CLASS_TOTAL_INCREASING = "total_increasing"
 
+# Derived from total_energy rather than read: (key, name, rtype, unit)
+_INSTANT_POWER = ("instant_power", "Instant power", "CALC", "kW")
+
+# Consecutive failed polls a charger or block keeps serving its last readings
+# for; after that its values go unknown and the charger's sensors unavailable
+_MAX_STALE_POLLS = 3
+
+# Upper bound in seconds for a whole poll, capped by 80% of the scan interval
+_POLL_TIMEOUT = 10
+
+
+@dataclass(slots=True, frozen=True)
+class Reading:
+    """One decoded value of a charger as stored in the coordinator data."""
+
+    name: str
+    value: Any
+    unit: str
+    rtype: str
+    slave_id: int
+
+
+# Unit -> (device_class, state_class) for numeric sensors
+_UNIT_TO_CLASS: Final[dict[str, tuple[SensorDeviceClass | None, str]]] = {
+    "kWh": (SensorDeviceClass.ENERGY, STATE_CLASS_TOTAL_INCREASING),
+    "kW": (SensorDeviceClass.POWER, STATE_CLASS_MEASUREMENT),
+    "V": (SensorDeviceClass.VOLTAGE, STATE_CLASS_MEASUREMENT),
+    "°C": (SensorDeviceClass.TEMPERATURE, STATE_CLASS_MEASUREMENT),
+}
+
+
 class HuaweiEmmaChargerCoordinator(DataUpdateCoordinator):
     """Coordinator to fetch Modbus data"""
 
@@ -40,76 +86,270 @@ class HuaweiEmmaChargerCoordinator(DataUpdateCoordinator):
         port: int,
         slave_id: int,
         scan_interval: timedelta,
+        frame_delay: float = 0.0,
+        max_in_flight: int = 1,
+        chargers: list[dict] | None = None,
     ):
         super().__init__(
             hass,
             _LOGGER,
             name="Huawei EMMA Charger",
             update_interval=scan_interval,
+            # Only notify entities when a polled value actually changed
+            always_update=False,
         )
         self.host = host
         self.port = port
         self.slave_id = slave_id
         self._last_energy: dict[int, float] = {}
-        self._last_time: dict[int, datetime] = {}
+        self._last_time: dict[int, float] = {}
         self._last_power: dict[int, float] = {}
+        self._power_readings: dict[int, Reading] = {}
+        # slave -> consecutive failed polls of the charger
+        self._failures: dict[int, int] = {}
+        # (slave, start, count) -> consecutive failed reads of the block
+        self._block_failures: dict[tuple[int, int, int], int] = {}
+        # (slave, start, count) -> when to retry a block the charger doesn't map
+        self._unmapped_blocks: dict[tuple[int, int, int], float] = {}
+        # data_key -> current value, read directly by the entities
+        self.values: dict[str, Any] = {}
+        self._modbus: SharedModbusClient | None = async_acquire_client(hass, host, port, frame_delay, max_in_flight)
+        # data_key -> (entry, expiry) of values with a ttl
+        self._value_cache: dict[str, tuple[Reading, float]] = {}
+        # Seeded with the chargers found during setup, so the first poll skips discovery
+        self._chargers: list[dict] | None = chargers or None
+        # Whether debug logging is on, refreshed once per update
+        self._debug = False
+        # (slave, start, count) -> data keys of the block members, built once per slave
+        self._block_keys: dict[tuple[int, int, int], tuple[str, ...]] = {}
+        self._chargers_expires = time.monotonic() + CHARGERS_CACHE_TTL if chargers else 0.0
+        # (slave, start, count) -> (registers, readings) of the last read of a block
+        self._raw_cache: dict[tuple[int, int, int], tuple[bytes, tuple[Reading, ...]]] = {}
 
-    def _read_registers(self, slave: int, address: int, count: int) -> list[int]:
-        """Read holding registers from the device."""
-        client = ModbusTcpClient(self.host, port=self.port)
-        try:
-            if not client.connect():
-                raise ConnectionError(f"Modbus connect failed to {self.host}:{self.port}")
-            response = client.read_holding_registers(address=address, count=count, slave=slave)
-            if isinstance(response, ExceptionResponse) or response.isError():
-                raise ModbusException(f"Error reading registers: {response}")
-            return response.registers
-        finally:
-            client.close()
-
-    async def _async_update_data(self) -> dict[str, dict]:
-        """Fetch data for each charger."""
-        data: dict[str, dict] = {}
-        chargers = await self.hass.async_add_executor_job(
-            identify_subdevices,
-            self.host,
-            self.port,
-            self.slave_id,
-            int(self.update_interval.total_seconds()),
-        )
+    def _update_instant_power(self, sid: int, data: dict[str, Reading], stale: set[str]) -> None:
+        """Derive the charging power of a slave from its energy counter."""
+        energy_key = f"total_energy_{sid}"
+        energy = data.get(energy_key)
+        if energy is None or energy_key in stale:
+            # A re-served counter says nothing about the power, leave it unknown
+            return
+        curr = energy.value
+        prev = self._last_energy.get(sid)
+        # Monotonic, so clock adjustments can't produce bogus power spikes
+        now = time.monotonic()
+        if curr == prev:
+            # Not charging, no need to divide
+            self._last_power[sid] = 0.0
+        else:
+            prev_time = self._last_time.get(sid)
+            if prev is not None and prev_time is not None:
+                secs = now - prev_time
+                if curr < prev and self._debug:
+                    _LOGGER.debug("Energy counter of slave %s went backwards: curr=%s prev=%s", sid, curr, prev)
+                # A counter reset yields no power rather than a negative one
+                delta = max(curr - prev, 0.0)
+                if secs > 0:
+                    self._last_power[sid] = round((delta * 3600) / secs, 3)
+                    if self._debug:
+                        _LOGGER.debug(
+                            "Energy counter calculated for slave %s after %s secs: curr=%s prev=%s power=%s",
+                            sid, secs, curr, prev, self._last_power[sid],
+                        )
+            self._last_energy[sid] = curr
+        # Advanced on every fresh sample, so power after an idle spell covers one poll only
+        self._last_time[sid] = now
+        key, name, rtype, unit = _INSTANT_POWER
+        power = self._last_power.get(sid)
+        reading = self._power_readings.get(sid)
+        if reading is None or reading.value != power:
+            reading = self._power_readings[sid] = Reading(name, power, unit, rtype, sid)
+        data[f"{key}_{sid}"] = reading
 
-        for charger in chargers:
-            sid = charger["slave_id"]
-            # Read all defined sensors
-            for key, name, address, quantity, rtype, gain, unit in SENSOR_TYPES:
-                data_key = f"{key}_{sid}"
-                try:
-                    regs = await self.hass.async_add_executor_job(
-                        self._read_registers, sid, address, quantity
-                    )
-                    value = _convert(regs, rtype, gain)
-                    data[data_key] = {"name": name, "value": value, "unit": unit, "rtype": rtype, "slave_id": sid}
-                except Exception as err:
-                    _LOGGER.error("Error reading %s from slave %s: %s", key, sid, err)
+    @property
+    def chargers(self) -> list[dict]:
+        """Return the chargers found by the last discovery."""
+        return self._chargers or []
 
+    def slave_available(self, sid: int) -> bool:
+        """Return whether a charger answered recently enough to trust its values."""
+        return self._failures.get(sid, 0) <= _MAX_STALE_POLLS
+
+    async def async_shutdown(self) -> None:
+        """Release the Modbus connection when the entry is unloaded."""
+        await super().async_shutdown()
+        if self._modbus is not None:
+            async_release_client(self.hass, self._modbus)
+            self._modbus = None
+
+    async def _async_poll_charger(self, sid: int) -> dict[str, Reading]:
+        """Read and decode all registers of one charger."""
+        data: dict[str, Reading] = {}
+        cache = self._value_cache
+        # Bound once, looked up for every block and register below
+        block_keys = self._block_keys
+        raw_cache = self._raw_cache
+        block_failures = self._block_failures
+        unmapped = self._unmapped_blocks
+        previous = self.data or {}
+        # Keys re-served from earlier reads instead of freshly read
+        stale: set[str] = set()
+        read = self._modbus.async_read_holding_registers
+        rejected = self._modbus.rejected_reads
+        now = time.monotonic()
+        # Whether any block was read, and whether a failed one hinted at a changed topology
+        answered = False
+        replaced = False
+        # Read all defined sensors, one request per register block; the
+        # requests of a round are pipelined, split blocks go to the next round
+        blocks = list(WIDE_PLAN)
+        while blocks:
+            pending = []
+            while blocks:
+                block = blocks.pop(0)
+                start, count, ttl, members, _layout = block
+                parts = SPLITS.get((start, count))
+                if parts and (start, count) in rejected:
+                    blocks[:0] = parts
+                    continue
+                if unmapped.get((sid, start, count), 0.0) > now:
+                    # Rejected by this charger, not asked again before the ttl runs out
+                    continue
+                keys = block_keys.get((sid, start, count))
+                if keys is None:
+                    keys = block_keys[(sid, start, count)] = tuple(f"{m[0]}_{sid}" for m in members)
+                if ttl and all(k in cache and cache[k][1] > now for k in keys):
+                    # Slow-changing values still fresh, skip the request
+                    for k in keys:
+                        data[k] = cache[k][0]
+                    continue
+                pending.append((block, keys, parts))
+            if not pending:
+                break
+            results = await asyncio.gather(
+                *(read(sid, block[0], block[1]) for block, _keys, _parts in pending),
+                return_exceptions=True,
+            )
+            for (block, keys, parts), regs in zip(pending, results):
+                start, count, ttl, members, decode = block
+                if isinstance(regs, (ConnectionError, TimeoutError)):
+                    # Fail fast so the coordinator backs off instead of hammering a dead socket
+                    raise UpdateFailed(f"Error communicating with {self.host}:{self.port}: {regs}") from regs
+                if isinstance(regs, Exception):
+                    if parts and isinstance(regs, ModbusError) and regs.code == ILLEGAL_DATA_ADDRESS:
+                        # The gateway rejects reads over unmapped registers, split the block
+                        _LOGGER.info("Reading registers %s-%s rejected by %s:%s, splitting: %s",
+                                     start, start + count - 1, self.host, self.port, regs)
+                        rejected.add((start, count))
+                        blocks.extend(parts)
+                        continue
+                    _LOGGER.error("Error reading registers %s-%s from slave %s: %s",
+                                  start, start + count - 1, sid, regs)
+                    if isinstance(regs, ModbusError) and regs.code in (ILLEGAL_DATA_ADDRESS, GATEWAY_TARGET_FAILED):
+                        replaced = True
+                        if regs.code == ILLEGAL_DATA_ADDRESS and ttl:
+                            # Registers this charger doesn't map, skip them until the ttl runs out
+                            unmapped[(sid, start, count)] = now + ttl
+                    # Bridge a few failed reads with the last known values
+                    failures = block_failures[(sid, start, count)] = block_failures.get((sid, start, count), 0) + 1
+                    stale.update(keys)
+                    for k in keys:
+                        if k in cache:
+                            data[k] = cache[k][0]
+                        elif k in previous and failures <= _MAX_STALE_POLLS:
+                            data[k] = previous[k]
+                    continue
+                if isinstance(regs, BaseException):
+                    raise regs
+                answered = True
+                block_failures.pop((sid, start, count), None)
+                unmapped.pop((sid, start, count), None)
+                cached = raw_cache.get((sid, start, count))
+                if cached is not None and cached[0] == regs:
+                    # Registers unchanged since the last poll, reuse the decoded readings
+                    readings = cached[1]
+                else:
+                    readings = tuple(
+                        Reading(name, value, unit, rtype, sid)
+                        for value, (_key, name, _kind, _gain, unit, rtype, _ttl) in zip(decode(regs), members)
+                    )
+                    raw_cache[(sid, start, count)] = (regs, readings)
+                for data_key, reading, member in zip(keys, readings, members):
+                    data[data_key] = reading
+                    if member[6]:
+                        cache[data_key] = (reading, now + member[6])
+        if replaced and not answered:
+            # No block could be read, the charger may have been replaced or
+            # removed; a single unmapped block says nothing about that
+            self._chargers_expires = 0.0
+        self._update_instant_power(sid, data, stale)
         return data
 
+    async def _async_update_data(self) -> dict[str, Reading]:
+        """Fetch data for each charger."""
+        self._debug = _LOGGER.isEnabledFor(logging.DEBUG)
+        chargers = self._chargers
+        if chargers is None or time.monotonic() > self._chargers_expires:
+            try:
+                discovered = await async_identify_subdevices(self._modbus, self.slave_id)
+            except (ConnectionError, TimeoutError, ModbusError, ValueError) as err:
+                if chargers is None:
+                    raise UpdateFailed(f"Error communicating with {self.host}:{self.port}: {err}") from err
+                # A discovery hiccup doesn't take the known chargers down, retry on the next poll
+                _LOGGER.warning("Rediscovering chargers at %s:%s failed, polling the known ones: %s",
+                                self.host, self.port, err)
+            else:
+                chargers = self._chargers = discovered
+                self._chargers_expires = time.monotonic() + CHARGERS_CACHE_TTL
+        budget = min(self.update_interval.total_seconds() * 0.8, _POLL_TIMEOUT)
 
-def _convert(regs: list[int], rtype: str, gain: int):
-    """Convert raw register values based on type and gain."""
-    if rtype == "STR":
-        raw = b"".join(r.to_bytes(2, "big") for r in regs)
-        return raw.decode("ascii", errors="ignore").rstrip("\x00")
-    if rtype == "U32":
-        val = (regs[0] << 16) | regs[1]
-        return val / gain
-    if rtype == "I32":
-        import struct
-        b = struct.pack(">HH", regs[0], regs[1])
-        val = struct.unpack(">i", b)[0]
-        return val / gain
-    _LOGGER.warning("Unknown type %s", rtype)
-    return None
+        # Each charger is polled as its own task; the shared connection
+        # bounds how many requests are on the wire at once
+        try:
+            async with asyncio.timeout(budget):
+                results = await asyncio.gather(
+                    *(self._async_poll_charger(charger["slave_id"]) for charger in chargers),
+                    return_exceptions=True,
+                )
+        except TimeoutError as err:
+            # Don't let a slow poll overlap the next scheduled one
+            raise UpdateFailed(f"Polling {self.host}:{self.port} took longer than {budget}s") from err
+        data: dict[str, Reading] = {}
+        failed: dict[int, Exception] = {}
+        for charger, result in zip(chargers, results):
+            sid = charger["slave_id"]
+            if isinstance(result, Exception):
+                failed[sid] = result
+                self._failures[sid] = self._failures.get(sid, 0) + 1
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                data.update(result)
+                self._failures.pop(sid, None)
+        if failed:
+            # Rediscover on the next poll in case the topology changed
+            self._chargers_expires = 0.0
+            if len(failed) == len(results):
+                raise next(iter(failed.values()))
+            # One broken charger doesn't take the others' fresh values down with
+            # it; its own last readings bridge a few failed polls
+            carried = set()
+            for sid, err in failed.items():
+                if self.slave_available(sid):
+                    _LOGGER.warning("Polling charger %s failed, keeping its last values: %s", sid, err)
+                    carried.add(sid)
+                elif self._failures[sid] == _MAX_STALE_POLLS + 1:
+                    _LOGGER.warning("Charger %s failed %s polls in a row, marking it unavailable: %s",
+                                    sid, self._failures[sid], err)
+            for key, reading in (self.data or {}).items():
+                # Power derived from a counter that is no longer read is never carried
+                if reading.slave_id in carried and reading.rtype != _INSTANT_POWER[2]:
+                    data[key] = reading
+        # Refreshed in place, entities hold a reference to it
+        values = self.values
+        values.clear()
+        for key, reading in data.items():
+            values[key] = reading.value
+        return data
 
 
 async def async_setup_entry(
@@ -122,43 +362,48 @@ async def async_setup_entry(
     port = entry.data.get(CONF_PORT, DEFAULT_PORT)
     slave = entry.data.get(CONF_SLAVE_ID, DEFAULT_SLAVE_ID)
     interval = entry.data.get(CONF_SCAN_INTERVAL, DEFAULT_SCAN_INTERVAL)
+    frame_delay = entry.data.get(CONF_FRAME_DELAY, DEFAULT_FRAME_DELAY) / 1000
+    max_in_flight = entry.data.get(CONF_MAX_IN_FLIGHT, DEFAULT_MAX_IN_FLIGHT)
+    chargers = hass.data[DOMAIN].get(entry.entry_id) or []
     coordinator = HuaweiEmmaChargerCoordinator(
-        hass, host, port, slave, timedelta(seconds=interval)
+        hass, host, port, slave, timedelta(seconds=interval), frame_delay, max_in_flight, chargers
     )
+    entry.async_on_unload(coordinator.async_shutdown)
     await coordinator.async_config_entry_first_refresh()
 
+    # Entities follow from the register definitions and the discovered
+    # chargers, so a block that failed to read doesn't drop its sensors
     entities: list[SensorEntity] = []
-    for key, info in coordinator.data.items():
-        rtype = info.get("rtype")
-        unit = info.get("unit")
-        slave_id = info.get("slave_id")
-        # Determine device_class & state_class
-        device_class = None
-        state_class = None
-        if rtype != "STR":
-            if unit == "kWh":
-                device_class = SensorDeviceClass.ENERGY
-                state_class = STATE_CLASS_TOTAL_INCREASING
-            elif unit == "kW":
-                device_class = SensorDeviceClass.POWER
-                state_class = STATE_CLASS_MEASUREMENT
-            elif unit == "V":
-                device_class = SensorDeviceClass.VOLTAGE
-                state_class = STATE_CLASS_MEASUREMENT
-            elif unit == "°C":
-                device_class = SensorDeviceClass.TEMPERATURE
-                state_class = STATE_CLASS_MEASUREMENT
-        entity = HuaweiEmmaChargerSensor(
-            coordinator,
-            key,
-            info.get("name"),
-            rtype,
-            unit,
-            device_class,
-            state_class,
-            slave_id,
+    for charger in coordinator.chargers:
+        slave_id = charger["slave_id"]
+        # One DeviceInfo per charger, shared by all of its sensors
+        device_info = DeviceInfo(
+            identifiers={(DOMAIN, f"{host}_{slave_id}")},
+            name=f"Huawei Charger {slave_id}",
+            manufacturer="Huawei",
+            model="EMMA Charger",
         )
-        entities.append(entity)
+        for key, name, rtype, unit in (
+            *((s.key, s.name, s.rtype, s.unit) for s in SENSOR_TYPES),
+            _INSTANT_POWER,
+        ):
+            # Determine device_class & state_class
+            if rtype == "STR":
+                device_class, state_class = None, None
+            else:
+                device_class, state_class = _UNIT_TO_CLASS.get(unit, (None, STATE_CLASS_MEASUREMENT))
+            entity = HuaweiEmmaChargerSensor(
+                coordinator,
+                f"{key}_{slave_id}",
+                name,
+                rtype,
+                unit,
+                device_class,
+                state_class,
+                slave_id,
+                device_info,
+            )
+            entities.append(entity)
     async_add_entities(entities)
 
 
@@ -175,15 +420,13 @@ class HuaweiEmmaChargerSensor(CoordinatorEntity, SensorEntity):
         device_class: SensorDeviceClass | None,
         state_class: str | None,
         slave_id: int,
+        device_info: DeviceInfo,
     ):
         super().__init__(coordinator)
         self._data_key = data_key
-        self._attr_device_info = DeviceInfo(
-            identifiers={(DOMAIN, f"{coordinator.host}_{slave_id}" )},
-            name=f"Huawei Charger {slave_id}",
-            manufacturer="Huawei",
-            model="EMMA Charger",
-        )
+        self._slave_id = slave_id
+        self._values = coordinator.values
+        self._attr_device_info = device_info
         self._attr_name = f"{name} (Slave {slave_id})"
         if rtype == "STR":
             self._attr_native_unit_of_measurement = None
@@ -195,8 +438,13 @@ class HuaweiEmmaChargerSensor(CoordinatorEntity, SensorEntity):
             self._attr_state_class = state_class
         self._attr_unique_id = f"{DOMAIN}_{data_key}"
 
+    @property
+    def available(self) -> bool:
+        """Return whether the charger behind this sensor is still answering."""
+        return super().available and self.coordinator.slave_available(self._slave_id)
+
     @property
     def native_value(self):
         """Return the current value of the sensor."""
-        return self.coordinator.data[self._data_key]["value"]
+        return self._values.get(self._data_key)
 
@@ -0,0 +1,37 @@
+"""Fake Modbus TCP gateway shared by the tests."""
+import asyncio
+import struct
+
+MBAP = struct.Struct(">HHHB")
+
+
+def frame(tid: int, unit: int, pdu: bytes) -> bytes:
+    return MBAP.pack(tid, 0, len(pdu) + 1, unit) + pdu
+
+
+class FakeGateway:
+    """Modbus TCP server handing each request to respond(writer, tid, unit, pdu)."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.connections = 0
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                tid, _protocol, length, unit = MBAP.unpack(await reader.readexactly(MBAP.size))
+                pdu = await reader.readexactly(length - 1)
+                await self.respond(writer, tid, unit, pdu)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
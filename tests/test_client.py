@@ -0,0 +1,195 @@
+"""Tests for the shared Modbus TCP client against a fake gateway."""
+import asyncio
+import struct
+
+import pytest
+
+from huawei_emma_charger import client
+from huawei_emma_charger.client import ModbusError, SharedModbusClient
+
+from gateway import MBAP, FakeGateway, frame
+
+
+def _registers(address: int, count: int) -> bytes:
+    """Response PDU whose registers hold their own addresses."""
+    return bytes([0x03, count * 2]) + b"".join(struct.pack(">H", address + i) for i in range(count))
+
+
+async def _answer_registers(writer, tid, unit, pdu):
+    address, count = struct.unpack(">HH", pdu[1:5])
+    writer.write(frame(tid, unit, _registers(address, count)))
+
+
+def test_out_of_order_responses():
+    """Pipelined responses are matched to their requests by transaction id."""
+    held = []
+
+    async def respond(writer, tid, unit, pdu):
+        held.append((tid, unit, pdu))
+        if len(held) == 2:
+            # Answer the second request first
+            for args in reversed(held):
+                await _answer_registers(writer, *args)
+
+    async def run():
+        async with FakeGateway(respond) as gateway:
+            shared = SharedModbusClient("127.0.0.1", gateway.port, max_in_flight=2)
+            try:
+                return await asyncio.gather(
+                    shared.async_read_holding_registers(1, 100, 2),
+                    shared.async_read_holding_registers(2, 200, 1),
+                )
+            finally:
+                shared.close()
+
+    first, second = asyncio.run(run())
+    assert first == struct.pack(">HH", 100, 101)
+    assert second == struct.pack(">H", 200)
+
+
+def test_exception_response():
+    """An exception PDU raises ModbusError carrying its code."""
+
+    async def respond(writer, tid, unit, pdu):
+        writer.write(frame(tid, unit, bytes([pdu[0] | 0x80, 0x02])))
+
+    async def run():
+        async with FakeGateway(respond) as gateway:
+            shared = SharedModbusClient("127.0.0.1", gateway.port)
+            try:
+                await shared.async_read_holding_registers(1, 100, 2)
+            finally:
+                shared.close()
+
+    with pytest.raises(ModbusError) as err:
+        asyncio.run(run())
+    assert err.value.code == 0x02
+    assert err.value.function == 0x03
+
+
+def test_timeout_reconnects(monkeypatch):
+    """A connection silent for several requests is dropped and the next request reconnects."""
+    monkeypatch.setattr(client, "REQUEST_TIMEOUT", 0.2)
+    requests = 0
+
+    async def respond(writer, tid, unit, pdu):
+        nonlocal requests
+        requests += 1
+        if requests > client._STALL_TIMEOUTS:
+            await _answer_registers(writer, tid, unit, pdu)
+
+    async def run():
+        async with FakeGateway(respond) as gateway:
+            shared = SharedModbusClient("127.0.0.1", gateway.port)
+            try:
+                for _ in range(client._STALL_TIMEOUTS):
+                    with pytest.raises(TimeoutError):
+                        await shared.async_read_holding_registers(1, 100, 1)
+                registers = await shared.async_read_holding_registers(1, 100, 1)
+            finally:
+                shared.close()
+            return registers, gateway.connections
+
+    registers, connections = asyncio.run(run())
+    assert registers == struct.pack(">H", 100)
+    assert connections == 2
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 2])
+def test_timeout_of_one_slave_keeps_connection(monkeypatch, max_in_flight):
+    """A slave that doesn't answer neither fails nor reconnects requests to slaves that do."""
+    monkeypatch.setattr(client, "REQUEST_TIMEOUT", 0.2)
+
+    async def respond(writer, tid, unit, pdu):
+        if unit != 1:
+            await _answer_registers(writer, tid, unit, pdu)
+
+    async def run():
+        async with FakeGateway(respond) as gateway:
+            shared = SharedModbusClient("127.0.0.1", gateway.port, max_in_flight=max_in_flight)
+            try:
+                # More polls than it takes to count a connection as stalled
+                polls = [
+                    await asyncio.gather(
+                        shared.async_read_holding_registers(1, 100, 1),
+                        shared.async_read_holding_registers(2, 200, 1),
+                        return_exceptions=True,
+                    )
+                    for _ in range(client._STALL_TIMEOUTS + 1)
+                ]
+            finally:
+                shared.close()
+            return polls, gateway.connections
+
+    polls, connections = asyncio.run(run())
+    for results in polls:
+        assert isinstance(results[0], TimeoutError)
+        assert results[1] == struct.pack(">H", 200)
+    assert connections == 1
+
+
+def test_invalid_frame_drops_connection():
+    """A frame with a bad length fails the request and the next one reconnects."""
+    requests = 0
+
+    async def respond(writer, tid, unit, pdu):
+        nonlocal requests
+        requests += 1
+        if requests == 1:
+            writer.write(MBAP.pack(tid, 0, 0, unit))
+        else:
+            await _answer_registers(writer, tid, unit, pdu)
+
+    async def run():
+        async with FakeGateway(respond) as gateway:
+            shared = SharedModbusClient("127.0.0.1", gateway.port)
+            try:
+                with pytest.raises(ConnectionError):
+                    await shared.async_read_holding_registers(1, 100, 1)
+                registers = await shared.async_read_holding_registers(1, 100, 1)
+            finally:
+                shared.close()
+            return registers, gateway.connections
+
+    registers, connections = asyncio.run(run())
+    assert registers == struct.pack(">H", 100)
+    assert connections == 2
+
+
+def test_read_device_information_pages():
+    """Device identification objects are parsed and paging is reported."""
+
+    async def respond(writer, tid, unit, pdu):
+        objects = bytes([0x87, 1, 2, 0x88, 3]) + b"8=C"
+        # MEI type, read code, conformity, more follows, next object id, number of objects
+        writer.write(frame(tid, unit, bytes([0x2B, 0x0E, 3, 0x83, 0xFF, 0x89, 2]) + objects))
+
+    async def run():
+        async with FakeGateway(respond) as gateway:
+            shared = SharedModbusClient("127.0.0.1", gateway.port)
+            try:
+                return await shared.async_read_device_information(1, 0x87)
+            finally:
+                shared.close()
+
+    information, next_object_id = asyncio.run(run())
+    assert information == {0x87: b"\x02", 0x88: b"8=C"}
+    assert next_object_id == 0x89
+
+
+def test_read_device_information_truncated():
+    """An object running past the end of the response raises ValueError."""
+
+    async def respond(writer, tid, unit, pdu):
+        writer.write(frame(tid, unit, bytes([0x2B, 0x0E, 3, 0x83, 0, 0, 2, 0x87, 1, 2, 0x88, 9]) + b"8=C"))
+
+    async def run():
+        async with FakeGateway(respond) as gateway:
+            shared = SharedModbusClient("127.0.0.1", gateway.port)
+            try:
+                await shared.async_read_device_information(1, 0x87)
+            finally:
+                shared.close()
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
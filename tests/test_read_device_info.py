@@ -0,0 +1,23 @@
+"""Tests for parsing EMMA sub-device descriptions."""
+from huawei_emma_charger.read_device_info import parse_device_description
+
+
+def test_parse_pairs():
+    assert parse_device_description(b"1=EMMA-A02;2=V100R024;8=CHARGER;5=82\x00\x00") == {
+        1: "EMMA-A02",
+        2: "V100R024",
+        8: "CHARGER",
+        5: "82",
+    }
+
+
+def test_parse_whitespace_around_keys():
+    assert parse_device_description(b"1=A; 8=CHARGER;5 =82") == {1: "A", 8: "CHARGER", 5: "82"}
+
+
+def test_parse_drops_non_ascii_before_parsing():
+    assert parse_device_description(b"\xff8=CHARGER;5=8\xfe2") == {8: "CHARGER", 5: "82"}
+
+
+def test_parse_skips_non_numeric_keys():
+    assert parse_device_description(b"x=1;8=a=b;;=2") == {8: "a=b"}
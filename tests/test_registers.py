@@ -0,0 +1,112 @@
+"""Tests for the register read plan and its generated decoders."""
+import logging
+import struct
+
+from huawei_emma_charger.const import Sensor
+from huawei_emma_charger.registers import PLAN, SPLITS, WIDE_PLAN, build_plan
+
+
+def _buffer(start: int, count: int, values: dict[int, bytes]) -> bytes:
+    """Raw bytes of count registers from start, unused ones filled with 0xFF."""
+    buf = bytearray(b"\xff" * count * 2)
+    for address, value in values.items():
+        offset = (address - start) * 2
+        buf[offset:offset + len(value)] = value
+    return bytes(buf)
+
+
+def _text(value: str, quantity: int) -> bytes:
+    return value.encode().ljust(quantity * 2, b"\x00")
+
+
+def test_plan_blocks():
+    assert [(start, count, ttl) for start, count, ttl, *_rest in PLAN] == [
+        (30000, 47, 3600), (30076, 34, 3600), (30500, 10, 0), (65524, 10, 3600),
+    ]
+    assert [(start, count, ttl) for start, count, ttl, *_rest in WIDE_PLAN] == [
+        (30000, 110, 3600), (30500, 10, 0), (65524, 10, 3600),
+    ]
+
+
+def test_splits_go_from_wide_to_contiguous():
+    assert [block[:2] for block in SPLITS[(30000, 110)]] == [(30000, 47), (30076, 34)]
+    assert [block[:2] for block in SPLITS[(30076, 34)]] == [(30076, 16), (30094, 16)]
+    assert (30500, 10) not in SPLITS
+
+
+def test_decode_measurements():
+    start, count, _ttl, members, decode = WIDE_PLAN[1]
+    buf = _buffer(start, count, {
+        30500: struct.pack(">I", 2301),
+        30502: struct.pack(">I", 2302),
+        30504: struct.pack(">I", 2303),
+        30506: struct.pack(">I", 12345),
+        30508: struct.pack(">i", -52),
+    })
+    assert dict(zip((m[0] for m in members), decode(buf))) == {
+        "phase_a_voltage": 230.1,
+        "phase_b_voltage": 230.2,
+        "phase_c_voltage": 230.3,
+        "total_energy": 12.345,
+        "charger_temp": -5.2,
+    }
+
+
+def test_decode_skips_gaps():
+    """Unused registers between members are read but don't shift the members after them."""
+    values = {
+        30000: _text("EMMA", 15),
+        30015: _text("ESN123", 16),
+        30031: _text("V100R024", 16),
+        30076: struct.pack(">I", 74),
+        30078: _text("AC-7KS", 14),
+        30094: _text("BT-1", 16),
+    }
+    expected = {
+        "offering_name": "EMMA",
+        "esn": "ESN123",
+        "software_version": "V100R024",
+        "rated_power": 7.4,
+        "charger_model": "AC-7KS",
+        "bluetooth_name": "BT-1",
+    }
+    for plan in (PLAN, WIDE_PLAN):
+        decoded = {}
+        for start, count, _ttl, members, decode in plan:
+            if start < 30500:
+                decoded.update(zip((m[0] for m in members), decode(_buffer(start, count, values))))
+        assert decoded == expected
+
+
+def test_build_plan_types():
+    sensors = (
+        Sensor("u16", "U16", 100, 1, "U16", 1, "", 0),
+        Sensor("i16", "I16", 101, 1, "I16", 10, "", 0),
+        Sensor("float", "Float", 104, 2, "FLOAT", 1, "", 0),
+        Sensor("other", "Other", 106, 1, "BITS", 1, "", 0),
+    )
+    (start, count, _ttl, members, decode), = build_plan(sensors, max_gap=2)
+    assert (start, count) == (100, 7)
+    buf = _buffer(start, count, {
+        100: struct.pack(">H", 65535),
+        101: struct.pack(">h", -15),
+        104: struct.pack(">f", 0.5),
+        106: b"\x00\x01",
+    })
+    assert decode(buf) == (65535.0, -1.5, 0.5, None)
+    assert [m[3] for m in members] == [1, 10, 1, None]
+
+
+def test_build_plan_skips_width_mismatch(caplog):
+    """A type not matching its register count is left out instead of shifting later members."""
+    sensors = (
+        Sensor("wide", "Wide", 100, 2, "U16", 1, "", 0),
+        Sensor("after", "After", 102, 2, "U32", 1, "", 0),
+    )
+    with caplog.at_level(logging.ERROR):
+        plan = build_plan(sensors, max_gap=2)
+    assert "wide" in caplog.text
+    (start, count, _ttl, members, decode), = plan
+    assert (start, count) == (102, 2)
+    assert [m[0] for m in members] == ["after"]
+    assert decode(struct.pack(">I", 70000)) == (70000.0,)
@@ -0,0 +1,296 @@
+"""Tests for the polling coordinator against a fake gateway."""
+import asyncio
+import struct
+import types
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip("homeassistant")
+
+from homeassistant.helpers.update_coordinator import UpdateFailed  # noqa: E402
+
+from huawei_emma_charger import client, sensor  # noqa: E402
+from huawei_emma_charger.client import GATEWAY_TARGET_FAILED, ILLEGAL_DATA_ADDRESS  # noqa: E402
+
+from gateway import FakeGateway, frame  # noqa: E402
+
+# Exception code answered by a charger with an internal fault
+_SLAVE_DEVICE_FAILURE = 0x04
+
+
+class Site:
+    """Chargers behind a fake gateway, recording the reads they are sent."""
+
+    def __init__(self, *slaves: int):
+        # slave -> address -> register value, unset registers read as 0
+        self.registers: dict[int, dict[int, int]] = {sid: {} for sid in slaves}
+        # Slaves that never answer
+        self.silent: set[int] = set()
+        # (slave, start, count) -> exception code answered instead of the registers
+        self.errors: dict[tuple[int, int, int], int] = {}
+        self.reads: list[tuple[int, int, int]] = []
+        self.discoveries = 0
+        # Exception code answered to device identification instead of the device list
+        self.discovery_error: int | None = None
+
+    def set_u32(self, sid: int, address: int, value: int) -> None:
+        self.registers[sid][address], self.registers[sid][address + 1] = divmod(value, 0x10000)
+
+    async def respond(self, writer, tid, unit, pdu):
+        if unit in self.silent:
+            return
+        if pdu[0] == 0x2B:
+            self.discoveries += 1
+            if self.discovery_error is not None:
+                writer.write(frame(tid, unit, bytes([0xAB, self.discovery_error])))
+                return
+            # Device list of the EMMA: count, then one description per charger
+            objects = bytes([0x87, 1, len(self.registers)])
+            for oid, sid in enumerate(self.registers, 0x88):
+                desc = f"5={sid};8=CHARGER".encode()
+                objects += bytes([oid, len(desc)]) + desc
+            writer.write(frame(tid, unit, bytes([0x2B, 0x0E, 3, 0x83, 0, 0, len(self.registers) + 1]) + objects))
+            return
+        address, count = struct.unpack(">HH", pdu[1:5])
+        self.reads.append((unit, address, count))
+        code = self.errors.get((unit, address, count))
+        if code is not None:
+            writer.write(frame(tid, unit, bytes([0x83, code])))
+            return
+        registers = self.registers[unit]
+        values = b"".join(struct.pack(">H", registers.get(address + i, 0)) for i in range(count))
+        writer.write(frame(tid, unit, bytes([0x03, count * 2]) + values))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic time seen by the coordinator, advanced by the tests."""
+    now = [1000.0]
+    monkeypatch.setattr(sensor, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def _run(site: Site, test) -> None:
+    """Run test(coordinator) against a gateway serving site, polling all of its chargers."""
+
+    async def run():
+        async with FakeGateway(site.respond) as gateway:
+            hass = types.SimpleNamespace(data={})
+            coordinator = sensor.HuaweiEmmaChargerCoordinator(
+                hass, "127.0.0.1", gateway.port, 0, timedelta(seconds=30),
+                chargers=[{"slave_id": sid} for sid in site.registers],
+            )
+            try:
+                await test(coordinator)
+            finally:
+                await coordinator.async_shutdown()
+
+    asyncio.run(run())
+
+
+async def _poll(coordinator) -> UpdateFailed | None:
+    """Refresh like the coordinator does, keeping the last data on failure."""
+    try:
+        coordinator.data = await coordinator._async_update_data()
+    except UpdateFailed as err:
+        return err
+    return None
+
+
+def test_decodes_registers(clock):
+    """Values are decoded and scaled, keyed by sensor and slave."""
+    site = Site(1)
+    site.set_u32(1, 30500, 2301)
+    site.set_u32(1, 30506, 12345)
+    site.set_u32(1, 30508, -52 & 0xFFFFFFFF)
+    site.registers[1][30015] = 0x4142
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        assert coordinator.values["phase_a_voltage_1"] == 230.1
+        assert coordinator.values["total_energy_1"] == 12.345
+        assert coordinator.values["charger_temp_1"] == -5.2
+        assert coordinator.values["esn_1"] == "AB"
+
+    _run(site, test)
+
+
+def test_ttl_blocks_served_from_cache(clock):
+    """Blocks whose members all have a ttl are read again only once it runs out."""
+    site = Site(1)
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        await _poll(coordinator)
+        assert site.reads.count((1, 30000, 110)) == 1
+        assert site.reads.count((1, 30500, 10)) == 2
+        clock[0] += 3601
+        await _poll(coordinator)
+        assert site.reads.count((1, 30000, 110)) == 2
+
+    _run(site, test)
+
+
+def test_rejected_block_is_split(clock):
+    """A wide read rejected with Illegal Data Address falls back to the finer blocks."""
+    site = Site(1)
+    site.errors[(1, 30000, 110)] = ILLEGAL_DATA_ADDRESS
+    site.registers[1][30094] = 0x4142
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        assert (1, 30000, 47) in site.reads
+        assert (1, 30076, 34) in site.reads
+        assert coordinator.values["bluetooth_name_1"] == "AB"
+        assert coordinator._modbus.rejected_reads == {(30000, 110)}
+
+    _run(site, test)
+
+
+def test_unmapped_block_skipped_until_ttl(clock):
+    """A block a charger rejects is retried after its ttl and doesn't trigger rediscovery."""
+    site = Site(1)
+    site.errors[(1, 65524, 10)] = ILLEGAL_DATA_ADDRESS
+
+    async def test(coordinator):
+        for _ in range(3):
+            assert await _poll(coordinator) is None
+        assert site.reads.count((1, 65524, 10)) == 1
+        assert site.discoveries == 0
+        assert "device_name_1" not in coordinator.values
+        clock[0] += 3601
+        await _poll(coordinator)
+        assert site.reads.count((1, 65524, 10)) == 2
+
+    _run(site, test)
+
+
+def test_charger_rejecting_everything_is_rediscovered(clock):
+    """A charger failing every block as if replaced triggers rediscovery on the next poll."""
+    site = Site(1)
+    for block in ((1, 30000, 110), (1, 30500, 10), (1, 65524, 10)):
+        site.errors[block] = GATEWAY_TARGET_FAILED
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        assert site.discoveries == 0
+        await _poll(coordinator)
+        assert site.discoveries == 1
+
+    _run(site, test)
+
+
+def test_failed_rediscovery_keeps_known_chargers(clock):
+    """When rediscovery fails, the chargers found before are still polled."""
+    site = Site(1, 2)
+    site.discovery_error = GATEWAY_TARGET_FAILED
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        clock[0] += 601
+        assert await _poll(coordinator) is None
+        assert await _poll(coordinator) is None
+        # Retried on every poll until it succeeds
+        assert site.discoveries == 2
+        assert coordinator.slave_available(1)
+        assert "phase_a_voltage_2" in coordinator.values
+        site.discovery_error = None
+        await _poll(coordinator)
+        assert site.discoveries == 3
+        await _poll(coordinator)
+        assert site.discoveries == 3
+
+    _run(site, test)
+
+
+def test_failed_block_carried_then_dropped(clock):
+    """A failing block keeps its last values for a few polls, the charger stays available."""
+    site = Site(1)
+    site.set_u32(1, 30500, 2301)
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        site.errors[(1, 30500, 10)] = _SLAVE_DEVICE_FAILURE
+        for _ in range(sensor._MAX_STALE_POLLS):
+            assert await _poll(coordinator) is None
+            assert coordinator.values["phase_a_voltage_1"] == 230.1
+            # Power from a re-served counter would be made up
+            assert "instant_power_1" not in coordinator.values
+        await _poll(coordinator)
+        assert "phase_a_voltage_1" not in coordinator.values
+        assert coordinator.values["esn_1"] == ""
+        assert coordinator.slave_available(1)
+        del site.errors[(1, 30500, 10)]
+        await _poll(coordinator)
+        assert coordinator.values["phase_a_voltage_1"] == 230.1
+        assert coordinator._block_failures == {}
+
+    _run(site, test)
+
+
+def test_failed_charger_carried_then_unavailable(clock, monkeypatch):
+    """A charger that stops answering keeps its last values for a few polls, then turns unavailable."""
+    monkeypatch.setattr(client, "REQUEST_TIMEOUT", 0.1)
+    site = Site(1, 2)
+    site.set_u32(1, 30500, 2301)
+    site.set_u32(2, 30500, 2302)
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        site.silent.add(1)
+        for _ in range(sensor._MAX_STALE_POLLS):
+            site.set_u32(2, 30500, site.registers[2][30501] + 1)
+            assert await _poll(coordinator) is None
+            assert coordinator.slave_available(1)
+            assert coordinator.values["phase_a_voltage_1"] == 230.1
+            assert "instant_power_1" not in coordinator.values
+            assert coordinator.values["phase_a_voltage_2"] == site.registers[2][30501] / 10
+        await _poll(coordinator)
+        assert not coordinator.slave_available(1)
+        assert not any(key.endswith("_1") for key in coordinator.values)
+        assert coordinator.slave_available(2)
+        site.silent.clear()
+        await _poll(coordinator)
+        assert coordinator.slave_available(1)
+        assert coordinator.values["phase_a_voltage_1"] == 230.1
+
+    _run(site, test)
+
+
+def test_all_chargers_failing_fails_the_update(clock, monkeypatch):
+    """The update fails when no charger answers at all."""
+    monkeypatch.setattr(client, "REQUEST_TIMEOUT", 0.1)
+    site = Site(1)
+
+    async def test(coordinator):
+        await _poll(coordinator)
+        site.silent.add(1)
+        assert isinstance(await _poll(coordinator), UpdateFailed)
+
+    _run(site, test)
+
+
+def test_instant_power(clock):
+    """Power follows the energy counter: rising, flat and reset."""
+    site = Site(1)
+
+    async def poll(coordinator, seconds, energy):
+        clock[0] += seconds
+        site.set_u32(1, 30506, energy)
+        await _poll(coordinator)
+        return coordinator.values["instant_power_1"]
+
+    async def test(coordinator):
+        # No earlier sample to compare with
+        assert await poll(coordinator, 0, 1000) is None
+        # 0.5 kWh in 36 s
+        assert await poll(coordinator, 36, 1500) == 50.0
+        assert await poll(coordinator, 36, 1500) == 0.0
+        # A counter reset yields no power rather than a negative one
+        assert await poll(coordinator, 36, 200) == 0.0
+        # After an idle spell, only the last poll's interval counts
+        await poll(coordinator, 3600, 200)
+        assert await poll(coordinator, 36, 300) == 10.0
+
+    _run(site, test)